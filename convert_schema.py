@@ -1,11 +1,17 @@
 
 import sqlalchemy as sa
 from sqlalchemy import schema, types, create_engine
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy_schemadisplay import create_schema_graph
 from pyswip import Prolog
 import argparse
-from frozendict import frozendict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import io
+import os
+import pickle
+import sys
+import tempfile
 
 NONEQUIV_CONTROL_GROUP_DESC = """Nonequivalent Control Group Design
     ---------------------------------
@@ -26,10 +32,63 @@ COUNTERBALANCED_DESC = """Counterbalanced Designs
     has experienced each treatment.
     """
 
+# fact-level data type for each SQLAlchemy type family;
+# subclasses (BIGINT, VARCHAR, TIMESTAMP, ...) resolve
+# through the type's MRO
+DATA_TYPES = {
+    sa.Integer: "numeric",
+    sa.Numeric: "numeric",
+    sa.String: "string",
+    sa.DateTime: "time",
+}
+
+# a treatment may have fewer than MAX_TREATMENT_LEVELS levels,
+# and the outcome's table must hold more than
+# MIN_RECORDS_PER_LEVEL records for each of them
+MAX_TREATMENT_LEVELS = 30
+MIN_RECORDS_PER_LEVEL = 20
+
+# where knowledge bases built from a database are kept between runs
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "logic-qed")
+
+# part of every cache key; bump whenever the facts emitted by
+# build_schema_rules change so older caches are ignored
+KB_FORMAT = 3
+
+# number of tables whose statistics are queried concurrently
+STATS_WORKERS = 8
+
+# rules that identify QEDs from the schema facts
+QED_RULES = (
+    # memoize the recursive path searches so each pair
+    # of tables or attributes is only explored once
+    ":- table tablesRelatedByPath/2, attributesRelatedByPath/2, variesWithTime/2",
+    # tables already on a path are kept in an AVL tree
+    ":- use_module(library(assoc))",
+    # candidate/2 is emitted as facts, so a schema
+    # without any candidates must still define it
+    ":- dynamic candidate/2",
+    "tablesDirectlyRelated(X, Y) :- related(Y, X, R)",
+    "tablesDirectlyRelated(X, Y) :- related(X, Y, R)",
+    "tablesRelatedByPath(X, Y, P) :- tablesDirectlyRelated(X, Y)",
+    r"tablesRelatedByPath(X, Y, P) :- tablesDirectlyRelated(Z, X), \+ get_assoc(Z, P, _), " + 
+        "put_assoc(X, P, true, P2), tablesRelatedByPath(Z, Y, P2)",
+    "tablesRelatedByPath(X, Y) :- empty_assoc(P), tablesRelatedByPath(X, Y, P)",
+    "attributesRelatedByPath(X, Y) :- attribute(X, T1), attribute(Y, T1)",
+    "attributesRelatedByPath(X, Y) :- attribute(X, T1), attribute(Y, T2), tablesRelatedByPath(T1, T2)",
+    "variesWithTime(T, O) :- attribute(O, OTable), attributesRelatedByPath(T, O), attribute(E, OTable), " + 
+        "dataType(E, time), attribute(E2, TTable), attribute(T, TTable), dataType(E2, time)",
+    "nonequivControlGroup(Out, Treat) :- candidate(Out, Treat), variesWithTime(Treat, Out)",
+    "counterbalancedDesign(Out, Treat) :- candidate(Out, Treat), variesWithTime(Treat, Out), levels(T, TreatLevels), TreatLevels > 3",
+    "qed(Out, Treat) :- nonequivControlGroup(Out, Treat)",
+)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--rules", dest="rule_path", default=None)
     parser.add_argument("--db-source", dest="db_path", default="postgresql://dgarant@localhost:5432/movielens")
+    parser.add_argument("--limit", dest="limit", type=int, default=None)
+    parser.add_argument("--refresh-schema", dest="refresh_schema", action="store_true")
 
     args = parser.parse_args()
 
@@ -37,164 +96,260 @@ def main():
         with open(args.rule_path, 'r') as rule_handle:
             rules = [r.strip() for r in rule_handle.readlines()]
     else:
-        rules = build_schema_rules(args.db_path)
+        rules = build_schema_rules(args.db_path, args.refresh_schema)
     rules.extend(register_qeds())
 
     prolog = Prolog()
     for rule in rules:
         print(rule)
-        prolog.assertz(rule)
-
-    report_on_qeds(prolog, "movie_gross")
-
-def report_on_qeds(prolog, outcome):
-    """ Prints out suitable QEDs for modeling a particular outcome """
-    nonequiv_control = list(get_unique_results(prolog, "nonequivControlGroup({0}, T)".format(outcome)))
-    if nonequiv_control:
-        print(NONEQUIV_CONTROL_GROUP_DESC)
-        print("Candidate treatments for outcome {0}:".format(outcome))
-        for elt in nonequiv_control:
-            print("\t{0}".format(elt["T"]))
+    consult_rules(prolog, rules)
+
+    report_on_qeds(prolog, "movie_gross", args.limit)
+
+def consult_rules(prolog, rules):
+    """ Loads rules into the Prolog engine by consulting them
+        from a temporary file, which SWI parses and indexes in
+        one pass instead of one assertz call per rule
+    """
+    # directives go first, and each predicate's
+    # clauses are kept contiguous in the file
+    grouped = sorted(rules, key=lambda rule: (not rule.startswith(":-"), rule.split("(", 1)[0]))
+    with tempfile.NamedTemporaryFile("w", suffix=".pl", delete=False) as handle:
+        # rules and facts use placeholder variables freely
+        handle.write(":- style_check(-singleton).\n")
+        for rule in grouped:
+            if rule:
+                handle.write(rule + ".\n")
+    try:
+        prolog.consult(handle.name)
+    finally:
+        os.remove(handle.name)
+
+def report_on_qeds(prolog, outcome, limit=None):
+    """ Prints out suitable QEDs for modeling a particular outcome,
+        listing at most limit candidate treatments per design
+    """
+    report_on_design(prolog, NONEQUIV_CONTROL_GROUP_DESC,
+        "nonequivControlGroup({0}, T)".format(outcome), outcome, limit)
     
     print("\n")
-    counterbalanced = list(get_unique_results(prolog, "counterbalancedDesign({0}, T)".format(outcome)))
-    if counterbalanced:
-        print(COUNTERBALANCED_DESC)
-        print("Candidate treatments for outcome {0}:".format(outcome))
-        for elt in counterbalanced:
-            print("\t{0}".format(elt["T"]))
-
-def get_unique_results(prolog, query_string):
-    """ Creates a generator of unique query results """
+    report_on_design(prolog, COUNTERBALANCED_DESC,
+        "counterbalancedDesign({0}, T)".format(outcome), outcome, limit)
+
+def report_on_design(prolog, description, query_string, outcome, limit):
+    """ Prints candidate treatments for one design as Prolog
+        finds them, with the design description ahead of the first
+    """
+    results = get_unique_results(prolog, query_string, limit)
+    first = next(results, None)
+    if first is None:
+        return
+    print(description)
+    print("Candidate treatments for outcome {0}:".format(outcome))
+    print("\t{0}".format(first["T"]))
+    for elt in results:
+        print("\t{0}".format(elt["T"]))
+
+def get_unique_results(prolog, query_string, limit=None):
+    """ Creates a generator of unique query results, 
+        stopping the query after limit results if given
+    """
+    if limit is not None and limit < 1:
+        return
     seen = set()
-    for elt in prolog.query(query_string, catcherrors=False):
-        frozenelt = frozendict(elt)
-        if frozenelt in seen:
-            continue
-        else:
-            seen.add(frozenelt)
-            yield elt
+    variables = None
+    solutions = prolog.query(query_string, catcherrors=False)
+    try:
+        for elt in solutions:
+            # every solution binds the same variables, so key
+            # each one on its values in a fixed variable order
+            if variables is None:
+                variables = sorted(elt)
+            key = tuple(elt[v] for v in variables)
+            if key in seen:
+                continue
+            else:
+                seen.add(key)
+                yield elt
+                if limit is not None and len(seen) >= limit:
+                    break
+    finally:
+        # release the Prolog query even when stopping early
+        solutions.close()
 
-def build_schema_rules(db_path):
+def build_schema_rules(db_path, refresh=False):
     """ Connects to a database, analyzes its schema, 
-        and constructs facts about that schema 
+        and constructs facts about that schema, reusing
+        the facts cached for the same schema unless refresh
     """
 
     # connect to the database and reflect metadata
     engine = create_engine(db_path)
     metadata = schema.MetaData()
     metadata.reflect(bind=engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+
+    cache_path = os.path.join(CACHE_DIR, schema_fingerprint(db_path, metadata) + ".pkl")
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, "rb") as cache_handle:
+            return pickle.load(cache_handle)
+
+    # identifiers are rendered once per table and column
+    # rather than on every fact that mentions them
+    ids = {}
+    for t in metadata.sorted_tables:
+        ids[t] = to_identifier(str(t))
+        for col in t.columns:
+            ids[col] = to_identifier(str(col))
+
+    # table statistics are independent round trips, so query
+    # them concurrently, each worker holding one connection
+    # for every table it scans
+    def scan_tables(tables):
+        with engine.connect() as conn:
+            return [table_stats(conn, t) for t in tables]
+    tables = metadata.sorted_tables
+    chunks = [tables[i::STATS_WORKERS] for i in range(min(STATS_WORKERS, len(tables)))]
+    stats = {}
+    with ThreadPoolExecutor(max_workers=STATS_WORKERS) as executor:
+        for chunk, chunk_stats in zip(chunks, executor.map(scan_tables, chunks)):
+            stats.update(zip(chunk, chunk_stats))
 
     # build up a knowledge base from the metadata
     kb = []
+    record_count = {}
+    num_distinct = {}
     for t in metadata.sorted_tables:
-        for fact in convert_table(session, t):
-            register_fact(kb, fact)
+        record_count[t], table_distinct = stats[t]
+        num_distinct.update(table_distinct)
+        kb.extend(convert_table(ids, t, record_count[t]))
         
         for col in t.columns:
-            for fact in convert_attribute(session, t, col):
-                register_fact(kb, fact)
+            kb.extend(convert_attribute(ids, t, col, num_distinct[col]))
             if col.primary_key:
-                register_fact(kb, convert_pk(t, col))
+                kb.append(convert_pk(ids, t, col))
             for fk in col.foreign_keys:
-                for fact in convert_fk(session, t, fk):
-                    register_fact(kb, fact)
+                kb.extend(convert_fk(ids, fk, record_count, num_distinct))
 
+    kb.extend(convert_candidates(ids, metadata.sorted_tables, record_count, num_distinct))
+
+    # write to a temporary file first so an interrupted or
+    # concurrent run never leaves a truncated cache behind
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_handle = tempfile.NamedTemporaryFile("wb", dir=CACHE_DIR, suffix=".tmp", delete=False)
+    try:
+        with cache_handle:
+            pickle.dump(kb, cache_handle)
+        os.replace(cache_handle.name, cache_path)
+    except BaseException:
+        os.remove(cache_handle.name)
+        raise
     return kb
 
+def schema_fingerprint(db_path, metadata):
+    """ Hashes the database location together with its tables,
+        their columns' names, types and keys, and the fact format
+    """
+    tables = sorted((t.schema or "", t.name, 
+                     tuple((c.name, str(c.type), c.primary_key,
+                            tuple(sorted(fk.target_fullname for fk in c.foreign_keys)))
+                           for c in t.columns))
+                    for t in metadata.sorted_tables)
+    return hashlib.sha1(repr((KB_FORMAT, db_path, tables)).encode()).hexdigest()
+
 
 def register_qeds():
     """ Builds a report of applicable QEDs based on the 
         knowledge base stored in the Prolog engine
     """
 
-    kb = []
-    register_rule(kb, "tablesDirectlyRelated(X, Y) :- related(Y, X, R)")
-    register_rule(kb, "tablesDirectlyRelated(X, Y) :- related(X, Y, R)")
-    register_rule(kb, "tablesRelatedByPath(X, Y, P) :- tablesDirectlyRelated(X, Y)")
-    register_rule(kb, "tablesRelatedByPath(X, Y, P) :- tablesDirectlyRelated(Z, X), \+ member(Z, P), tablesRelatedByPath(Z, Y, [X|P])")
-    register_rule(kb, "tablesRelatedByPath(X, Y) :- tablesRelatedByPath(X, Y, [])")
-    register_rule(kb, "attributesRelatedByPath(X, Y) :- attribute(X, T1), attribute(Y, T1)")
-    register_rule(kb, "attributesRelatedByPath(X, Y) :- attribute(X, T1), attribute(Y, T2), tablesRelatedByPath(T1, T2)")
-    register_rule(kb, "isNumeric(X) :- dataType(X, INTEGER)")
-    register_rule(kb, "isNumeric(X) :- dataType(X, BIGINT)")
-    register_rule(kb, "isNumeric(X) :- dataType(X, NUMERIC)")
-    register_rule(kb, "variesWithTime(T, O) :- attribute(O, OTable), attributesRelatedByPath(T, O), attribute(E, OTable), " + 
-                                             "dataType(E, time), attribute(E2, TTable), attribute(T, TTable), dataType(E2, time)")
-    register_rule(kb, "suitableAsTreatment(T, O) :- attribute(O, T1), recordCount(T1, OutRecords), " + 
-                      "isNumeric(O), levels(T, TreatLevels), TreatLevels < 30, OutRecords / TreatLevels > 20, T \= O")
-    register_rule(kb, "nonequivControlGroup(Out, Treat) :- suitableAsTreatment(Treat, Out), variesWithTime(Treat, Out)")
-    register_rule(kb, "counterbalancedDesign(Out, Treat) :- suitableAsTreatment(Treat, Out), variesWithTime(Treat, Out), levels(T, TreatLevels), TreatLevels > 3")
-    register_rule(kb, "qed(Out, Treat) :- nonequivControlGroup(Out, Treat)")
-
-    return kb
+    return list(QED_RULES)
 
-def register_rule(kb, rule):
-    kb.append(rule)
-
-def register_fact(kb, fact):
-    kb.append(fact)
+def table_stats(conn, table):
+    """ Counts the records in a table along with the number of
+        distinct values in each of its columns, in a single query
+    """
+    # a single-column primary key has as many distinct
+    # values as the table has records, so skip counting it
+    pk = list(table.primary_key.columns)
+    unique_key = pk[0] if len(pk) == 1 else None
+    columns = [col for col in table.columns if col is not unique_key]
+    counts = [sa.func.count()] + [sa.func.count(sa.distinct(col)) for col in columns]
+    row = conn.execute(sa.select(*counts).select_from(table)).one()
+    num_distinct = dict(zip(columns, row[1:]))
+    if unique_key is not None:
+        num_distinct[unique_key] = row[0]
+    return row[0], num_distinct
 
-def convert_table(session, table):
-    num_records = session.execute(table.count()).first()[0]
-    return ["table({0})".format(to_identifier(str(table))),
-            "recordCount({0}, {1})".format(
-                to_identifier(str(table)), num_records)]
+def convert_table(ids, table, num_records):
+    table_label = ids[table]
+    return [f"table({table_label})",
+            f"recordCount({table_label}, {num_records})"]
 
 
-def convert_type(typename):
-    if typename in ("INTEGER", "BIGINT", "NUMERIC"):
-        return "numeric"
-    elif typename.startswith("VARCHAR"):
-        return "string"
-    elif typename.startswith("TIMESTAMP"):
-        return "time"
-    else:
-        raise ValueError("Unknown data type: {0}".format(typename))
+@functools.lru_cache(maxsize=None)
+def convert_type(type_class):
+    for cls in type_class.__mro__:
+        if cls in DATA_TYPES:
+            return DATA_TYPES[cls]
+    raise ValueError("Unknown data type: {0}".format(type_class.__name__))
 
-def convert_attribute(session, table, attr):
-    attr_label = to_identifier(str(attr)) 
-    facts = ["attribute({0}, {1})".format(attr_label, table),
-              "dataType({0}, {1})".format(attr_label, 
-                        convert_type(str(attr.type)))]
+def convert_attribute(ids, table, attr, num_distinct):
+    attr_label = ids[attr]
+    attr_type = convert_type(type(attr.type))
+    facts = [f"attribute({attr_label}, {ids[table]})",
+             f"dataType({attr_label}, {attr_type})"]
     # number of distinct values gives the number of 
     # levels if this were to be a treatment
-    num_distinct = session.query(sa.func.count(sa.distinct(attr))).first()[0]
-    facts.append("levels({0}, {1})".format(attr_label, num_distinct))
+    facts.append(f"levels({attr_label}, {num_distinct})")
+    if attr_type == "numeric":
+        facts.append(f"isNumeric({attr_label})")
     return facts
 
-def convert_pk(table, key):
-    return "primaryKey({0}, {1})".format(
-        to_identifier(str(key)), table.name)
+def convert_pk(ids, table, key):
+    return f"primaryKey({ids[key]}, {ids[table]})"
 
-def convert_fk(session, table, key):
+def convert_fk(ids, key, record_count, num_distinct):
     oneColumn = key.column
     manyColumn = key.parent
     rname = key.name
-    rules = ["related({0}, {1}, {2})".format(oneColumn.table, manyColumn.table, rname),
-            "cardinality(OneCard, ManyCard, {0})".format(rname)]
-    rules.append("key({0}, {1})".format(to_identifier(str(oneColumn)), rname))
-    rules.append("key({0}, {1})".format(to_identifier(str(manyColumn)), rname))
-
-    # select avg count of many-side elements, 
-    # grouping by primary key of 1-side
-    num_distinct_ref = session.query(oneColumn.table).join(manyColumn.table).group_by(oneColumn).count()
-    total_rows = session.execute(manyColumn.table.count()).first()[0]
-    rules.append("averageManySize({0}, {1})".format(rname, total_rows / float(num_distinct_ref)))
+    rules = [f"related({ids[oneColumn.table]}, {ids[manyColumn.table]}, {rname})",
+             f"cardinality(OneCard, ManyCard, {rname})"]
+    rules.append(f"key({ids[oneColumn]}, {rname})")
+    rules.append(f"key({ids[manyColumn]}, {rname})")
+
+    # avg count of many-side elements per 1-side key is the
+    # number of many-side rows over its distinct key values
+    num_distinct_ref = num_distinct[manyColumn] or 1
+    total_rows = record_count[manyColumn.table]
+    rules.append(f"averageManySize({rname}, {total_rows / float(num_distinct_ref)})")
     return rules
 
+def convert_candidates(ids, tables, record_count, num_distinct):
+    """ Pairs each numeric outcome with the attributes suitable
+        as its treatment, given the levels of the treatment and
+        the number of records in the outcome's table
+    """
+    columns = [col for t in tables for col in t.columns]
+    treatments = [(col, num_distinct[col]) for col in columns
+                  if 0 < num_distinct[col] < MAX_TREATMENT_LEVELS]
+    facts = []
+    for outcome in columns:
+        if convert_type(type(outcome.type)) != "numeric":
+            continue
+        out_records = record_count[outcome.table]
+        for treatment, levels in treatments:
+            if out_records / levels > MIN_RECORDS_PER_LEVEL and treatment is not outcome:
+                facts.append(f"candidate({ids[outcome]}, {ids[treatment]})")
+    return facts
+
 def to_identifier(name):
-    return name.replace(".", "_")
+    return sys.intern(name.replace(".", "_"))
     
 def create_schema_image(metadata):
     graph = create_schema_graph(metadata=metadata, 
         show_datatypes=True, show_indexes=False, rankdir='LR')
-    import tempfile, Image
-    with tempfile.NamedTemporaryFile(suffix=".png") as fout:
-        graph.write(fout.name, format="png")
-        Image.open(fout.name).show()
+    from PIL import Image
+    Image.open(io.BytesIO(graph.create(format="png"))).show()
 
 if __name__ == "__main__":
     main()
@@ -1,12 +0,0 @@
-try:
-    frozenset
-except NameError:
-    from sets import ImmutableSet as frozenset
-
-class frozendict(dict):
-    __slots__ = ('_hash',)
-    def __hash__(self):
-        rval = getattr(self, '_hash', None)
-        if rval is None:
-            rval = self._hash = hash(frozenset(self.iteritems()))
-        return rval